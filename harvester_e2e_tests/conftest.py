@@ -274,6 +274,13 @@ def pytest_addoption(parser):
         default=config_data.get('terraform-provider-rancher'),
         help=('Version of Terraform Rancher Provider')
     )
+    parser.addoption(
+        '--terraform-parallelism',
+        action='store',
+        type=int,
+        default=config_data.get('terraform-parallelism', 30),
+        help=('Number of concurrent operations as Terraform walks the graph')
+    )
 
 
 def pytest_configure(config):
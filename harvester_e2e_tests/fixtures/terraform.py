@@ -1,5 +1,10 @@
+import os
 import re
 import json
+import time
+import shlex
+import shutil
+from functools import lru_cache, partial
 from pathlib import Path
 from datetime import datetime
 from subprocess import run, PIPE
@@ -8,6 +13,9 @@ from dataclasses import dataclass, field
 import pytest
 from pkg_resources import parse_version
 
+_parse_version = lru_cache(maxsize=None)(parse_version)
+_run = partial(run, stdout=PIPE, stderr=PIPE)
+
 TF_PROVIDER = '''
 terraform {
   required_version = "%(tf_version)s"
@@ -156,10 +164,73 @@ TF_MACHINE_POOLS = '''
 '''
 
 
+#: CSI `ESC [ ... final`, OSC `ESC ] ... BEL|ESC \\` and two bytes escape sequences
+_ANSI_RE = re.compile(rb"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])")
+
+
 def remove_ansicode(ctx):
-    if isinstance(ctx, bytes):
-        ctx = ctx.decode()
-    return re.sub(r"\x1b|\[\d+m", "", ctx)
+    if isinstance(ctx, str):
+        ctx = ctx.encode()
+    if b"\x1b" not in ctx:
+        return ctx.decode()
+    return _ANSI_RE.sub(b"", ctx).decode()
+
+
+def write_if_changed(filepath, payload):
+    if filepath.exists() and filepath.read_bytes() == payload:
+        return False
+    filepath.write_bytes(payload)
+    return True
+
+
+TF_PLUGIN_CACHE = Path("~/.terraform.d/plugin-cache").expanduser()
+TF_REGISTRY = "https://registry.terraform.io/v1/providers"
+TF_VERSIONS_CACHE = Path("~/.cache/harvester-e2e/tf_versions.json").expanduser()
+TF_VERSIONS_TTL = 6 * 60 * 60  # seconds
+TF_REGISTRY_TIMEOUT = 30  # seconds
+
+
+#: Shared session to keep registry connections alive, be created on first request
+_session = None
+
+
+def latest_provider_version(provider):
+    global _session
+    import requests
+
+    try:
+        cached = json.loads(TF_VERSIONS_CACHE.read_text())
+    except (OSError, ValueError):
+        cached = dict()
+
+    entry = cached.get(provider, {})
+    if time.time() - entry.get('timestamp', 0) > TF_VERSIONS_TTL:
+        _session = _session or requests.Session()
+        # revalidate stale entry, registry responds 304 without body if unchanged
+        headers = {'If-None-Match': entry['etag']} if entry.get('etag') else {}
+        try:
+            resp = _session.get(f"{TF_REGISTRY}/{provider}", headers=headers,
+                                timeout=TF_REGISTRY_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException:
+            # keep using the stale versions when registry is unreachable
+            if 'versions' not in entry:
+                raise
+        else:
+            if 200 == resp.status_code:
+                entry = dict(versions=resp.json()['versions'], etag=resp.headers.get('ETag'))
+            assert 'versions' in entry, f"Unable to get versions of {provider}: {resp}"
+            if resp.status_code in (200, 304):
+                # other responses keep the stale entry, to be refreshed on next session
+                entry['timestamp'] = time.time()
+                cached[provider] = entry
+                try:
+                    TF_VERSIONS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+                    TF_VERSIONS_CACHE.write_text(json.dumps(cached))
+                except OSError:
+                    pass
+
+    return max((parse_version(v), v) for v in entry['versions'])[1]
 
 
 @pytest.fixture(scope="session")
@@ -170,9 +241,7 @@ def tf_script_dir(request):
 @pytest.fixture(scope="session")
 def tf_provider_version(request, harvester_metadata):
     version = request.config.getoption('--terraform-provider-harvester')
-    import requests
-    resp = requests.get("https://registry.terraform.io/v1/providers/harvester/harvester")
-    latest = max(resp.json()['versions'], key=parse_version)
+    latest = latest_provider_version("harvester/harvester")
     version = None if version == '0.0.0-dev' else version
     harvester_metadata['Terraform Harvester Provider Version'] = f"{version} || {latest}"
     return version or latest
@@ -182,16 +251,14 @@ def tf_provider_version(request, harvester_metadata):
 def tf_provider_rancher_ver(request, harvester_metadata):
     version = request.config.getoption('--terraform-provider-rancher')
     if not version:
-        import requests
-        resp = requests.get("https://registry.terraform.io/v1/providers/rancher/rancher2")
-        version = max(resp.json()['versions'], key=parse_version)
+        version = latest_provider_version("rancher/rancher2")
     harvester_metadata['Terraform Rancher Provider Version'] = version
     return version
 
 
 @pytest.fixture(scope="session")
 def tf_executor(tf_script_dir):
-    run(str(tf_script_dir / "terraform_install.sh"), stdout=PIPE, stderr=PIPE)
+    _run([str(tf_script_dir / "terraform_install.sh")])
     executor = tf_script_dir / "bin/terraform"
     assert executor.is_file()
 
@@ -199,8 +266,14 @@ def tf_executor(tf_script_dir):
 
 
 @pytest.fixture(scope="session")
-def tf_harvester(api_client, tf_script_dir, tf_provider_version, tf_executor):
-    harv = TerraformHarvester(tf_executor, tf_script_dir / datetime.now().strftime("%Hh%Mm_%m-%d"))
+def tf_parallelism(request):
+    return request.config.getoption('--terraform-parallelism')
+
+
+@pytest.fixture(scope="session")
+def tf_harvester(api_client, tf_script_dir, tf_provider_version, tf_executor, tf_parallelism):
+    harv = TerraformHarvester(tf_executor, tf_script_dir / datetime.now().strftime("%Hh%Mm_%m-%d"),
+                              tf_parallelism)
     kuebconfig = api_client.generate_kubeconfig()
     out, err, exc_code = harv.initial_provider(kuebconfig, tf_provider_version)
     assert not err and 0 == exc_code
@@ -209,9 +282,10 @@ def tf_harvester(api_client, tf_script_dir, tf_provider_version, tf_executor):
 
 @pytest.fixture(scope="module")
 def tf_rancher(rancher_api_client, tf_script_dir, tf_provider_rancher_ver, tf_executor,
-               harvester, rancher):
+               tf_parallelism, harvester, rancher):
     tf_rancher = TerraformRancher(tf_executor,
-                                  tf_script_dir / datetime.now().strftime("%Hh%Mm_%m-%d"))
+                                  tf_script_dir / datetime.now().strftime("%Hh%Mm_%m-%d"),
+                                  tf_parallelism)
     kubeconfig = rancher_api_client.generate_kubeconfig(harvester["id"], harvester["name"])
 
     out, err, exc_code = \
@@ -233,83 +307,105 @@ def tf_rancher_resource(tf_provider_rancher_ver):
 
 
 class TerraformHarvester:
-    def __init__(self, executor, workdir):
-        self.executor = executor.resolve()
+    def __init__(self, executor, workdir, parallelism=30):
+        self.executor = str(executor.resolve())
         self.workdir = workdir
+        self.parallelism = parallelism
         self.workdir.mkdir(exist_ok=True)
+        self._workdir_str = str(self.workdir)
 
     def exec_command(self, cmd, raw=False, **kws):
-        rv = run(cmd, shell=True, stdout=PIPE, stderr=PIPE, cwd=self.workdir, **kws)
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        rv = _run(cmd, cwd=self._workdir_str, **kws)
 
         if raw:
             return rv
         return remove_ansicode(rv.stdout), remove_ansicode(rv.stderr), rv.returncode
 
     def execute(self, cmd, raw=False, **kws):
-        return self.exec_command(f"{self.executor} {cmd}", raw=raw, **kws)
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        return self.exec_command([self.executor, *cmd], raw=raw, **kws)
 
     def initial_provider(self, kubeconfig, provider_version):
         kubefile = self.workdir / "kubeconfig"
-        with open(kubefile, "w") as f:
-            f.write(kubeconfig)
+        write_if_changed(kubefile, kubeconfig.encode())
 
-        with open(self.workdir / "provider.tf", "w") as f:
-            f.write(TF_PROVIDER % dict(
-                tf_version=">=0.13", config_path=kubefile.resolve(),
-                provider_source="harvester/harvester", provider_version=provider_version
-            ))
+        write_if_changed(self.workdir / "provider.tf", (TF_PROVIDER % dict(
+            tf_version=">=0.13", config_path=os.path.abspath(kubefile),
+            provider_source="harvester/harvester", provider_version=provider_version
+        )).encode())
 
         # cleanup terraform plugin cache
-        local_plugin_path = "~/.terraform.d/plugins/registry.terraform.io"
-        local_plugin_tf = "harvester/harvester/0.0.0-dev/linux_amd64"
-        rv = run(
-            f"rm -rf ~/.terraform.d/plugins/registry.terraform.io/harvester/harvester &&"
-            f" mkdir -p {local_plugin_path}/{local_plugin_tf}",
-            shell=True, stdout=PIPE, stderr=PIPE, cwd=self.workdir)
-        assert not remove_ansicode(rv.stderr) and 0 == rv.returncode
+        local_plugin_path = Path("~/.terraform.d/plugins/registry.terraform.io").expanduser()
+        local_plugin_tf = local_plugin_path / "harvester/harvester/0.0.0-dev/linux_amd64"
+        if (local_plugin_path / "harvester/harvester").exists():
+            shutil.rmtree(local_plugin_path / "harvester/harvester")
+        local_plugin_tf.mkdir(parents=True, exist_ok=True)
 
         if provider_version == "0.0.0-dev":
             docker_plugin_path = "/root/.terraform.d/plugins/terraform.local/local"
             docker_plugin_tf = "harvester/0.0.0-dev/linux_amd64/terraform-provider-harvester_v0.0.0-dev"  # noqa: E501
-            rv = run(
-                f"docker run --pull=always -q --rm --name harv-tf-master-head"
-                f" -v {local_plugin_path}/{local_plugin_tf}:/_tf"
-                f" rancher/terraform-provider-harvester:master-head-amd64"
-                f' bash -c "cp {docker_plugin_path}/{docker_plugin_tf} /_tf/"',
-                shell=True, stdout=PIPE, stderr=PIPE, cwd=self.workdir
-            )
+            rv = _run([
+                "docker", "run", "--pull=always", "-q", "--rm", "--name", "harv-tf-master-head",
+                "-v", f"{local_plugin_tf}:/_tf",
+                "rancher/terraform-provider-harvester:master-head-amd64",
+                "bash", "-c", f"cp {docker_plugin_path}/{docker_plugin_tf} /_tf/"
+            ], cwd=self._workdir_str)
             assert not remove_ansicode(rv.stderr) and 0 == rv.returncode
 
-        return self.execute("init")
+        # dev build is always refreshed from the container, do not reuse cached one
+        return self.init(plugin_cache=provider_version != "0.0.0-dev")
+
+    def init(self, plugin_cache=True):
+        kws = dict()
+        if plugin_cache:
+            cache_dir = os.environ.get("TF_PLUGIN_CACHE_DIR", str(TF_PLUGIN_CACHE))
+            Path(cache_dir).expanduser().mkdir(parents=True, exist_ok=True)
+            # workdir is new for each session, so there is no lock file to verify the
+            # cached plugins against, terraform>=1.4 would skip the cache without this.
+            kws['env'] = dict(os.environ, TF_PLUGIN_CACHE_DIR=cache_dir)
+            kws['env'].setdefault("TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE", "true")
+        return self.execute(["init", "-input=false"], **kws)
 
     def save_as(self, content, filename, ext=".tf"):
         filepath = self.workdir / f"{filename}{ext}"
-        with open(filepath, "w") as f:
-            f.write(content)
+        filepath.write_bytes(content.encode())
+
+    def apply_resource(self, resource_type, resource_name, parallelism=None):
+        return self.apply_resources([(resource_type, resource_name)], parallelism)
+
+    def apply_resources(self, targets, parallelism=None):
+        return self.execute(self._targeted("apply", targets, parallelism))
 
-    def apply_resource(self, resource_type, resource_name):
-        return self.execute(f"apply -auto-approve -target {resource_type}.{resource_name}")
+    def destroy_resource(self, resource_type, resource_name, parallelism=None):
+        return self.destroy_resources([(resource_type, resource_name)], parallelism)
 
-    def destroy_resource(self, resource_type, resource_name):
-        return self.execute(f"destroy -auto-approve -target {resource_type}.{resource_name}")
+    def destroy_resources(self, targets, parallelism=None):
+        return self.execute(self._targeted("destroy", targets, parallelism))
+
+    def _targeted(self, action, targets, parallelism=None):
+        cmd = [action, "-auto-approve", f"-parallelism={parallelism or self.parallelism}"]
+        for rtype, rname in targets:
+            cmd += ("-target", f"{rtype}.{rname}")
+        return cmd
 
 
 class TerraformRancher(TerraformHarvester):
     def initial_provider(self, kubeconfig, provider_version, harvester, rancher):
         kubefile = self.workdir / "kubeconfig"
-        with open(kubefile, "w") as f:
-            f.write(kubeconfig)
+        write_if_changed(kubefile, kubeconfig.encode())
 
-        with open(self.workdir / "provider.tf", "w") as f:
-            f.write(TF_PROVIDER_RANCHER % {
-                "provider_source": "rancher/rancher2",
-                "provider_version": provider_version,
-                "rancher_endpoint": rancher["endpoint"],
-                "rancher_token": rancher["token"],
-                "harvester_name": harvester["name"]
-            })
+        write_if_changed(self.workdir / "provider.tf", (TF_PROVIDER_RANCHER % {
+            "provider_source": "rancher/rancher2",
+            "provider_version": provider_version,
+            "rancher_endpoint": rancher["endpoint"],
+            "rancher_token": rancher["token"],
+            "harvester_name": harvester["name"]
+        }).encode())
 
-        return self.execute("init")
+        return self.init()
 
 
 @dataclass
@@ -321,46 +417,70 @@ class ResourceContext:
 
 
 class BaseTerraformResource:
-    #: Be used to store sub classes of BaseTerraformResource
+    #: Be used to store sub classes of BaseTerraformResource, sorted by `support_to` descending
     #: Type: Dict[Type[BaseTerraformResource], List[Type[BaseTerraformResource]]]
     _sub_classes = dict()
 
     #: Be used to adjust whether the class is support to specific version
     #: Type: str
     support_to = "0.0.0"
+    #: Parsed `support_to`, be updated on subclass registration
+    #: Type: packaging.version.Version
+    _parsed_support_to = _parse_version(support_to)
+
+    #: Be used to adjust json2hcl output to terraform syntax in one pass
+    _HCL_FIXUPS = re.compile(
+        r'"(resource)"'         # resource should not quote
+        r'|"(data\.\S+?)"'      # data should not quote
+        r'|"(.+?)" =( {)?'      # property should not quote, block should not have `=`
+        r'|(\S+) = {'           # block should not have `=`
+    )
+
+    @staticmethod
+    def _hcl_fixup(match):
+        resource, data, prop, prop_block, name = match.groups()
+        if prop:
+            return f"{prop} {{" if prop_block else f"{prop} ="
+        if name:
+            return f"{name} {{"
+        return resource or data
 
     @classmethod
     def is_support(cls, target_version):
-        return parse_version(target_version) >= parse_version(cls.support_to)
+        return _parse_version(target_version) >= cls._parsed_support_to
 
     @classmethod
     def for_version(cls, version):
-        for c in sorted(cls._sub_classes.get(cls, []),
-                        reverse=True, key=lambda x: parse_version(x.support_to).release):
-            if c.is_support(version):
+        target = _parse_version(version)
+        for c in cls._sub_classes.get(cls, []):
+            if target >= c._parsed_support_to:
                 return c
         return cls
 
     def __init_subclass__(cls):
+        cls._parsed_support_to = _parse_version(cls.support_to)
         for parent in cls.__mro__:
             if issubclass(parent, BaseTerraformResource):
-                cls._sub_classes.setdefault(parent, []).append(cls)
+                subs = cls._sub_classes.setdefault(parent, [])
+                subs.append(cls)
+                # keep newest first, so `for_version` picks the first supported one
+                subs.sort(reverse=True, key=lambda x: x._parsed_support_to.release)
 
     def __init__(self, converter):
         self.executor = Path(converter).resolve()
+        self._hcl_cache = dict()
 
     def convert_to_hcl(self, json_spec, raw=False):
-        rv = run(f"echo {json.dumps(json_spec)!r} | {self.executor!s}",
-                 shell=True, stdout=PIPE, stderr=PIPE)
+        key = json.dumps(json_spec, sort_keys=True, separators=(',', ':'))
+        if not raw and key in self._hcl_cache:
+            return self._hcl_cache[key]
+
+        rv = _run([str(self.executor)], input=json.dumps(json_spec).encode())
         if raw:
             return rv
         if rv.stderr:
             raise TypeError(rv.stderr, rv.stdout, rv.returncode)
-        out = rv.stdout.decode()
-        out = re.sub(r'"resource"', "resource", out)    # resource should not quote
-        out = re.sub(r"\"(.+?)\" =", r"\1 =", out)      # property should not quote
-        out = re.sub(r'"(data\.\S+?)"', r"\1", out)     # data should not quote
-        out = re.sub(r"(.[^ ]+) = {", r"\1 {", out)     # block should not have `=`
+        out = self._hcl_cache[key] = self._HCL_FIXUPS.sub(self._hcl_fixup, rv.stdout.decode())
         return out
 
     def make_resource(self, resource_type, resource_name, *, convert=True, **properties):